@@ -1,46 +1,25 @@
 import os
 import streamlit as st
-import pdfplumber
+import pymupdf
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from xml.sax.saxutils import escape
 from io import BytesIO
-import textwrap
-import base64 # <-- FIX: Moved 'import base64' back to the top
-
-# ---------------------- PAGE THEME FIX ----------------------
-st.markdown("""
-    <style>
-        html, body, [data-testid="stAppViewContainer"], [data-testid="stHeader"] {
-            background-color: #f4f7fb !important;
-            color: #000 !important;
-        }
-    </style>
-""", unsafe_allow_html=True)
-
-# ---------------------- API KEY HANDLING ----------------------
-api_key = ""
-
-# 1. Use Streamlit Secrets (deployment)
-if "GOOGLE_API_KEY" in st.secrets:
-    api_key = st.secrets["GOOGLE_API_KEY"]
-
-# 2. Use local environment variable (testing)
-elif os.environ.get("GOOGLE_API_KEY"):
-    api_key = os.environ.get("GOOGLE_API_KEY")
-
-# Configure Gemini
-if api_key:
-    genai.configure(api_key=api_key)
-else:
-    # If key is missing, configure with a placeholder to prevent immediate crash 
-    try:
-        genai.configure(api_key="placeholder")
-    except:
-        pass
-
-
-MODEL_NAME = "models/gemini-2.5-flash"
+import hashlib
+import numpy as np
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from pdf_text_extractor import extract_page_range
 
 st.set_page_config(
     page_title="AI PDF Simplifier + Chat",
@@ -48,11 +27,13 @@ st.set_page_config(
     page_icon="📄"
 )
 
-# ---------------------- PREMIUM UI CSS ----------------------
-st.markdown("""
+# ---------------------- THEME + PREMIUM UI CSS ----------------------
+# One stylesheet, emitted once per run
+APP_CSS = """
 <style>
-body, .main {
+html, body, .main, [data-testid="stAppViewContainer"], [data-testid="stHeader"] {
     background-color: #f4f7fb !important;
+    color: #000 !important;
 }
 
 .main .block-container {
@@ -87,85 +68,466 @@ textarea, input {
     border: 1px solid #ccc !important;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
+
+# ---------------------- API KEY HANDLING ----------------------
+api_key = ""
+
+# 1. Use Streamlit Secrets (deployment)
+if "GOOGLE_API_KEY" in st.secrets:
+    api_key = st.secrets["GOOGLE_API_KEY"]
+
+# 2. Use local environment variable (testing)
+elif os.environ.get("GOOGLE_API_KEY"):
+    api_key = os.environ.get("GOOGLE_API_KEY")
+
+# Configure Gemini
+@st.cache_resource
+def configure_gemini(key):
+    # genai.configure() drops the SDK's cached clients, so only run it once per key
+    if key:
+        genai.configure(api_key=key)
+    else:
+        # If key is missing, configure with a placeholder to prevent immediate crash 
+        try:
+            genai.configure(api_key="placeholder")
+        except:
+            pass
+
+configure_gemini(api_key)
+
+
+MODEL_NAME = "models/gemini-2.5-flash"
+
+# PyMuPDF is fast enough that a process pool only pays off on long documents
+PARALLEL_MIN_PAGES = 100
+# Extraction speedup flattens out past ~6 worker processes
+MAX_EXTRACT_WORKERS = 6
+# Leading pages checked for a text layer before extracting the whole PDF
+SCAN_SNIFF_PAGES = 3
+
+# PDFs longer than this would not fit gemini-2.5-flash's ~1M-token input in one pass
+# (~4 chars per token, with headroom for the prompt), so they are summarized
+# in as few even slices as fit that budget, then merged (map-reduce)
+MAP_REDUCE_MIN_CHARS = 3000000
+MAP_WORKERS = 4
+# Concurrent map requests can hit Gemini's per-minute quota. Retries wait as long as
+# the 429 asks (else 10s, 20s, 40s...), with jitter so workers don't retry in step,
+# and give up once a chunk has spent RATE_LIMIT_MAX_WAIT seconds waiting
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 10
+RATE_LIMIT_MAX_WAIT = 120
+
+# Number of finished Gemini answers kept in memory
+RESPONSE_CACHE_SIZE = 128
+# Map-step notes get their own store, so one long PDF can't push out everyone's answers
+NOTES_CACHE_SIZE = 64
+
+# Chat keeps PDFs of at least this many (estimated) tokens in a Gemini context cache;
+# smaller ones are sent inline. Storage is billed per token-hour, so below ~50 pages
+# the discount on cached input tokens rarely pays for itself
+CONTEXT_CACHE_MIN_TOKENS = 32768
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+
+# Chat on very long PDFs sends only the excerpts most similar to the question
+RETRIEVAL_MIN_CHARS = 200000
+RETRIEVAL_CHUNK_CHARS = 2000
+RETRIEVAL_TOP_K = 8
+EMBED_MODEL = "models/gemini-embedding-001"
+EMBED_DIMENSIONS = 768
+# Largest batchEmbedContents request the API accepts
+EMBED_BATCH_SIZE = 100
+
+# Parses the three-section Simplify answer in one pass. Only the section numbers
+# are matched, so reworded titles or odd spacing in the headers still parse
+SECTION_RE = re.compile(
+    r"===\s*SECTION\s*1\b[^=]*===\s*(?P<simplified>.*?)"
+    r"===\s*SECTION\s*2\b[^=]*===\s*(?P<bullets>.*?)"
+    r"===\s*SECTION\s*3\b[^=]*===\s*(?P<glossary>.*)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# Uploaded PDFs are served from here (see enableStaticServing in .streamlit/config.toml)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# That folder is public, so uploads are only kept while recently previewed
+STATIC_MAX_FILES = 32
+STATIC_TTL = timedelta(hours=1)
 
 # ---------------------- SESSION STATE ----------------------
 if "raw_text" not in st.session_state:
     st.session_state.raw_text = ""
 
-if "uploaded_file_obj" not in st.session_state:
-    st.session_state.uploaded_file_obj = None
+if "pdf_file_id" not in st.session_state:
+    st.session_state.pdf_file_id = ""
+
+if "pdf_bytes" not in st.session_state:
+    st.session_state.pdf_bytes = b""
 
 if "chat_answer" not in st.session_state:
     st.session_state.chat_answer = ""
 
+if "pdf_hash" not in st.session_state:
+    st.session_state.pdf_hash = ""
+
+if "gemini_cache" not in st.session_state:
+    st.session_state.gemini_cache = None
+
+if "gemini_cache_failed" not in st.session_state:
+    st.session_state.gemini_cache_failed = False
+
 # ---------------------- PDF TEXT EXTRACTION ----------------------
-def extract_pdf_text(uploaded_file):
-    text = ""
-    try:
-        # We assume the file object is already seeked to 0 before calling this function
-        # But for robustness, we seek here too.
-        uploaded_file.seek(0)
-        with pdfplumber.open(uploaded_file) as pdf:
-            for page in pdf.pages:
-                content = page.extract_text()
-                if content:
-                    text += content + "\n"
-        # Reset pointer for subsequent reads (like display or other functions)
-        uploaded_file.seek(0) 
-    except Exception as e:
-        st.error(f"PDF extraction error: {e}")
+def hash_pdf(pdf_bytes):
+    # Content hash of the upload, used as the cache key for extraction and Gemini calls
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+def looks_scanned(doc):
+    # Sniff the first few pages: images but no text layer means the rest is scanned too,
+    # so skip parsing every page just to get nothing back
+    sample = [doc[i] for i in range(min(SCAN_SNIFF_PAGES, doc.page_count))]
+    return bool(sample) and all(not page.get_text().strip() and page.get_images() for page in sample)
+
+# Errors propagate to the caller so that only real results are memoized;
+# a failed extraction is retried on the next upload of the same bytes
+@st.cache_data(show_spinner="Extracting text from PDF...", max_entries=16)
+def extract_pdf_text(pdf_bytes):
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+        scanned = looks_scanned(doc)
+
+    if scanned:
+        st.warning("This looks like a scanned (image-only) PDF. OCR is not enabled, so no text could be extracted.")
         return ""
+
+    page_numbers = list(range(1, page_count + 1))
+
+    if page_count < PARALLEL_MIN_PAGES:
+        return extract_page_range(pdf_bytes, page_numbers)
+
+    # Text extraction is CPU-bound, so split the pages across processes
+    workers = min(os.cpu_count() or 1, MAX_EXTRACT_WORKERS, page_count)
+    if workers < 2:
+        # A one-process pool only adds pickling the PDF over to it
+        return extract_page_range(pdf_bytes, page_numbers)
+    chunk_size = -(-page_count // workers)
+    chunks = [page_numbers[i:i + chunk_size] for i in range(0, page_count, chunk_size)]
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        return "".join(executor.map(extract_page_range, repeat(pdf_bytes), chunks))
+
+def publish_pdf(pdf_bytes, pdf_hash):
+    # Write the upload once under static/ so the browser fetches and caches it by URL.
+    # Called on every preview rerun: touching the file keeps it from being pruned
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    path = os.path.join(STATIC_DIR, f"{pdf_hash}.pdf")
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # Write under a temp name and rename, so a concurrent upload of the same
+        # PDF never serves a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=STATIC_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+    prune_static()
+
+def prune_static():
+    # Drop uploads nobody has previewed within the TTL, and all but the newest few
+    cutoff = time.time() - STATIC_TTL.total_seconds()
+    entries = []
+    for entry in os.scandir(STATIC_DIR):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass  # removed by another session
+    entries.sort(reverse=True)
+    pdfs = [(mtime, path) for mtime, path in entries if path.endswith(".pdf")]
+    stale = pdfs[STATIC_MAX_FILES:] + [(mtime, path) for mtime, path in pdfs[:STATIC_MAX_FILES] if mtime < cutoff]
+    # Leftover temp files from an interrupted write
+    stale += [(mtime, path) for mtime, path in entries if path.endswith(".tmp") and mtime < cutoff]
+    for _, path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# ---------------------- PROMPT TEMPLATES ----------------------
+# Built once at import; each click only fills in the PDF text / question
+SUMMARY_PROMPT = """
+Rewrite the PDF content into EXACTLY THREE SECTIONS:
+
+=== SECTION 1: SIMPLIFIED TEXT ===
+Write 2–4 easy paragraphs.
+
+=== SECTION 2: BULLET POINT SUMMARY ===
+List 5–10 important bullet points.
+
+=== SECTION 3: GLOSSARY ===
+List 5–10 important terms with short meanings.
+
+PDF CONTENT:
+{text}
+"""
+
+CHUNK_PROMPT = """
+Summarize this part of a longer PDF as detailed bullet-point notes.
+Keep every key fact, definition and technical term; do not add anything new.
+
+PDF PART {index} OF {total}:
+{text}
+"""
+
+# Teacher rules for chat, passed as the system instruction on every chat path
+CHAT_RULES = """
+You are an expert teacher and document summarizer. Your goal is to provide a comprehensive, educational, and high-quality answer to the user's question, strictly based on the provided PDF content.
+
+**Answer Formatting Rules:**
+
+1.  **Detail and Length:** Do not limit the length of your response. Provide a detailed answer that fully addresses the question.
+2.  **Educational Style:** Use clear, simple language suitable for a student. Break down complex topics into digestible parts.
+3.  **Structure (Mandatory):**
+    * **Start** with a clear, concise introductory summary.
+    * **Use bold subheadings** (e.g., **Key Features**, **In Simple Terms**, **Example**) to structure the body of your response.
+    * **Use Markdown bullet points (-) or numbered lists (1.)** for any lists, types, steps, or features.
+4.  **Analogy/Example:** For any concept or definition, actively try to provide a simple, real-world analogy or example to aid understanding.
+
+**Source Constraint:**
+- You MUST only use the PDF content provided.
+- Do NOT output headings like "Answer:" or similar.
+- Do NOT copy messy formatting from the PDF.
+
+If the answer is not found in the PDF, reply: 
+"Sorry, this specific information is not available in the document you provided."
+"""
+
+CHAT_PROMPT = """
+PDF CONTENT:
+{text}
+
+QUESTION:
+{question}
+"""
+
+# The PDF and rules already live in the context cache, so only the question is sent
+CACHED_CHAT_PROMPT = """
+QUESTION:
+{question}
+"""
+
+# ---------------------- GEMINI CALLS ----------------------
+@st.cache_resource
+def get_model():
+    # One model handle (and its client connection) shared by every rerun
+    return genai.GenerativeModel(MODEL_NAME)
+
+@st.cache_resource
+def get_chat_model():
+    # Chat rules ride along as the system instruction instead of the prompt text
+    return genai.GenerativeModel(MODEL_NAME, system_instruction=CHAT_RULES)
+
+@st.cache_resource
+def response_cache():
+    # Finished answers keyed by (pdf_hash, prompt digest), shared by all sessions
+    return {}
+
+@st.cache_resource
+def notes_cache():
+    # Map-step notes keyed by (model, chunk prompt digest), shared by all sessions
+    return {}
+
+@st.cache_resource
+def response_cache_lock():
+    # Sessions run in separate threads, so eviction and inserts are serialized
+    # (one lock covers both stores)
+    return threading.Lock()
+
+def prompt_key(scope, prompt):
+    return (scope, hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest())
+
+def remember(key, text, cache=None, max_size=RESPONSE_CACHE_SIZE):
+    cache = response_cache() if cache is None else cache
+    with response_cache_lock():
+        if len(cache) >= max_size:
+            cache.pop(next(iter(cache)), None)
+        cache[key] = text
+
+def stream_gemini(prompt, pdf_hash, placeholder, model_fn=get_model):
+    # Stream the answer into placeholder as it is generated; repeats come from the cache
+    key = prompt_key(pdf_hash, prompt)
+    text = response_cache().get(key)
+    if text is None:
+        stream = model_fn().generate_content(prompt, stream=True)
+        text = placeholder.write_stream(chunk.text for chunk in stream)
+        remember(key, text)
+    placeholder.empty()
     return text
 
+def use_context_cache(text):
+    # Rough 4-chars-per-token estimate; close enough for the caching minimum
+    return len(text) // 4 >= CONTEXT_CACHE_MIN_TOKENS
+
+def get_cached_chat_model():
+    # Upload the PDF text to Gemini once; later questions only reference it.
+    # Returns None if explicit caching isn't available, so chat falls back to inline
+    if st.session_state.gemini_cache_failed:
+        return None
+    cache = st.session_state.gemini_cache
+    if cache is None or cache.expire_time <= datetime.now(timezone.utc) + timedelta(minutes=1):
+        try:
+            cache = caching.CachedContent.create(
+                model=MODEL_NAME,
+                system_instruction=CHAT_RULES,
+                contents=[st.session_state.raw_text],
+                ttl=CONTEXT_CACHE_TTL,
+            )
+        except google_exceptions.GoogleAPICallError:
+            # Not offered for this key's tier/model, or over quota: don't retry for this PDF
+            st.session_state.gemini_cache = None
+            st.session_state.gemini_cache_failed = True
+            return None
+        st.session_state.gemini_cache = cache
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+def drop_context_cache():
+    if st.session_state.gemini_cache is not None:
+        try:
+            st.session_state.gemini_cache.delete()
+        except Exception:
+            pass  # already expired
+        st.session_state.gemini_cache = None
+    st.session_state.gemini_cache_failed = False
+
+def chunk_text(text, max_chars):
+    # Split on line boundaries so no chunk cuts a paragraph in half
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        if current and len(current) + len(line) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current += line + "\n"
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def split_for_map(text):
+    # Fewest slices that each fit the input budget, evenly sized, so even the
+    # longest PDFs only cost a handful of map requests. The 5% slack keeps
+    # line-boundary splitting from spilling a tiny extra slice
+    count = -(-len(text) // MAP_REDUCE_MIN_CHARS)
+    return chunk_text(text, min(MAP_REDUCE_MIN_CHARS, len(text) // count * 21 // 20))
+
+def use_retrieval(text):
+    return len(text) >= RETRIEVAL_MIN_CHARS
+
+def embed(texts, task_type):
+    result = genai.embed_content(
+        model=EMBED_MODEL,
+        content=texts,
+        task_type=task_type,
+        output_dimensionality=EMBED_DIMENSIONS,
+    )
+    vectors = np.asarray(result["embedding"], dtype=np.float32)
+    # Truncated embeddings aren't unit length; normalize so dot product = cosine
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+@st.cache_data(show_spinner="Indexing PDF for chat...", max_entries=8)
+def build_chunk_index(pdf_hash, _text):
+    # Embedded once per document; keyed on pdf_hash since the text derives from it
+    chunks = chunk_text(_text, RETRIEVAL_CHUNK_CHARS)
+    # One batch request per EMBED_BATCH_SIZE chunks, several in flight at once
+    batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=MAP_WORKERS) as executor:
+        vectors = list(executor.map(embed, batches, repeat("retrieval_document")))
+    return chunks, np.vstack(vectors)
+
+def retrieve_excerpts(pdf_hash, text, question):
+    chunks, chunk_emb = build_chunk_index(pdf_hash, text)
+    if len(chunks) <= RETRIEVAL_TOP_K:
+        return text
+    scores = chunk_emb @ embed([question], "retrieval_query")[0]
+    top = np.argpartition(-scores, RETRIEVAL_TOP_K)[:RETRIEVAL_TOP_K]
+    # Keep document order so the excerpts still read naturally
+    return "\n...\n".join(chunks[i] for i in sorted(top))
+
+def retry_delay(error):
+    # Seconds the 429 asks us to wait (google.rpc.RetryInfo), over gRPC or REST
+    for detail in error.details or ():
+        if hasattr(detail, "retry_delay"):
+            return detail.retry_delay.seconds + detail.retry_delay.nanos / 1e9
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            return float(str(detail["retryDelay"]).rstrip("s"))
+    return None
+
+def summarize_chunk(model, prompt):
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return model.generate_content(prompt).text
+        except google_exceptions.ResourceExhausted as e:
+            delay = retry_delay(e) or RATE_LIMIT_BACKOFF * 2 ** attempt
+            delay *= random.uniform(1, 1.25)
+            if attempt == RATE_LIMIT_RETRIES or time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+
+def summarize_chunks(chunks):
+    # Map step. Each chunk's notes are cached on their own, so after a failed chunk
+    # (or on a PDF that shares chunks) only the missing ones are requested again
+    prompts = [CHUNK_PROMPT.format(index=i, total=len(chunks), text=chunk) for i, chunk in enumerate(chunks, start=1)]
+    keys = [prompt_key(MODEL_NAME, prompt) for prompt in prompts]
+    cache = notes_cache()
+    with response_cache_lock():
+        notes = {key: cache[key] for key in keys if key in cache}
+    missing = [(key, prompt) for key, prompt in zip(keys, prompts) if key not in notes]
+
+    if missing:
+        model = get_model()
+        # The requests are network-bound, so threads overlap their latency
+        with ThreadPoolExecutor(max_workers=MAP_WORKERS) as executor:
+            futures = [(key, executor.submit(summarize_chunk, model, prompt)) for key, prompt in missing]
+        for key, future in futures:
+            if future.exception() is None:
+                notes[key] = future.result()
+                remember(key, notes[key], cache, NOTES_CACHE_SIZE)
+        for _, future in futures:
+            future.result()  # re-raise the first failure, after the successes are cached
+
+    return [notes[key] for key in keys]
+
+def parse_sections(output):
+    match = SECTION_RE.search(output)
+    if not match:
+        return None
+    return tuple(part.strip() for part in match.group("simplified", "bullets", "glossary"))
+
 # ---------------------- PDF GENERATOR ----------------------
 def generate_pdf(simplified, bullets, glossary):
     buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
+    # ReportLab's platypus engine handles wrapping and page breaks for us
+    doc = SimpleDocTemplate(buffer, pagesize=letter, leftMargin=40, rightMargin=40, topMargin=50, bottomMargin=50)
+
+    styles = getSampleStyleSheet()
+    heading_style = ParagraphStyle("PdfHeading", parent=styles["Heading2"], fontSize=15, leading=19)
+    body_style = ParagraphStyle("PdfBody", parent=styles["BodyText"], fontSize=11, leading=14)
+    bullet_style = ParagraphStyle("PdfBullet", parent=body_style, leftIndent=35, bulletIndent=15)
 
-    width, height = letter
-    y = height - 50
-    line_height = 14
+    story = []
 
     def heading(text):
-        nonlocal y
-        c.setFont("Helvetica-Bold", 15)
-        c.drawString(40, y, text)
-        y -= 25
+        story.append(Paragraph(escape(text), heading_style))
 
     def paragraph(text):
-        nonlocal y
-        c.setFont("Helvetica", 11)
-        for line in textwrap.wrap(text, 100):
-            if y < 60:
-                c.showPage()
-                y = height - 50
-            c.drawString(40, y, line)
-            y -= line_height
-        y -= 10
+        for line in text.split("\n"):
+            if line.strip():
+                story.append(Paragraph(escape(line.strip()), body_style))
+        story.append(Spacer(1, 10))
 
     def bullet_list(text):
-        nonlocal y
-        c.setFont("Helvetica", 11)
         items = [line.strip() for line in text.split("\n") if line.strip()]
         for item in items:
             clean = item.lstrip("*- ").strip()
-            wrapped = textwrap.wrap(clean, 95)
-
-            if y < 60:
-                c.showPage()
-                y = height - 50
-
-            c.drawString(55, y, f"• {wrapped[0]}")
-            y -= line_height
-
-            for sub in wrapped[1:]:
-                if y < 60:
-                    c.showPage()
-                    y = height - 50
-                c.drawString(75, y, sub)
-                y -= line_height
-        y -= 10
+            story.append(Paragraph(escape(clean), bullet_style, bulletText="•"))
+        story.append(Spacer(1, 10))
 
     heading("Simplified PDF Output")
 
@@ -178,7 +540,7 @@ def generate_pdf(simplified, bullets, glossary):
     heading("3. Glossary")
     bullet_list(glossary)
 
-    c.save()
+    doc.build(story)
     buffer.seek(0)
     return buffer
 
@@ -193,47 +555,60 @@ if not api_key:
 uploaded_file = st.file_uploader("Upload your PDF", type="pdf")
 
 if uploaded_file:
-    # Check if a new file was uploaded or if it's the first time
-    if st.session_state.uploaded_file_obj is None or st.session_state.uploaded_file_obj.name != uploaded_file.name:
+    # file_id is stable across reruns, so the bytes are only read and hashed
+    # when the uploader has received a new file
+    if uploaded_file.file_id != st.session_state.pdf_file_id:
+        st.session_state.pdf_file_id = uploaded_file.file_id
+
+        # Compare content, not file names: a renamed copy of the same PDF is not new,
+        # and a different PDF that happens to share a name is
+        pdf_bytes = uploaded_file.getvalue()
+        pdf_hash = hash_pdf(pdf_bytes)
+
+        if pdf_hash != st.session_state.pdf_hash:
 
-        st.session_state.uploaded_file_obj = uploaded_file
-        text = extract_pdf_text(uploaded_file)
-        st.session_state.raw_text = text
+            drop_context_cache()
 
-        st.success("PDF uploaded successfully!")
+            # Keep the bytes; everything downstream works off this single read
+            st.session_state.pdf_bytes = pdf_bytes
+            st.session_state.pdf_hash = pdf_hash
+            try:
+                st.session_state.raw_text = extract_pdf_text(st.session_state.pdf_bytes)
+                # A scanned PDF has already been warned about; don't claim success
+                if st.session_state.raw_text:
+                    st.success("PDF uploaded successfully!")
+            except Exception as e:
+                st.error(f"PDF extraction error: {e}")
+                # Forget the upload so that re-uploading the same file tries again
+                st.session_state.raw_text = ""
+                st.session_state.pdf_bytes = b""
+                st.session_state.pdf_hash = ""
 
     # ---------------------- SIMPLIFY BUTTON ----------------------
-    # Only enable simplify if API key is present
-    if st.button("✨ Simplify PDF", disabled=not api_key):
+    # Only enable simplify if API key is present and there is text to send
+    if st.button("✨ Simplify PDF", disabled=not api_key or not st.session_state.raw_text):
         if not api_key:
              st.error("Cannot simplify: API Key is required.")
         else:
             with st.spinner("Simplifying using Gemini..."):
 
-                prompt = f"""
-Rewrite the PDF content into EXACTLY THREE SECTIONS:
-
-=== SECTION 1: SIMPLIFIED TEXT ===
-Write 2–4 easy paragraphs.
-
-=== SECTION 2: BULLET POINT SUMMARY ===
-List 5–10 important bullet points.
-
-=== SECTION 3: GLOSSARY ===
-List 5–10 important terms with short meanings.
+                try:
+                    if len(st.session_state.raw_text) > MAP_REDUCE_MIN_CHARS:
+                        # Too long for one pass: the final prompt sees the per-chunk notes instead
+                        source_text = "\n\n".join(summarize_chunks(split_for_map(st.session_state.raw_text)))
+                    else:
+                        source_text = st.session_state.raw_text
 
-PDF CONTENT:
-{st.session_state.raw_text}
-"""
+                    prompt = SUMMARY_PROMPT.format(text=source_text)
 
-                try:
-                    model = genai.GenerativeModel(MODEL_NAME)
-                    response = model.generate_content(prompt)
-                    output = response.text
+                    output = stream_gemini(prompt, st.session_state.pdf_hash, st.empty())
 
-                    simplified = output.split("=== SECTION 2")[0].replace("=== SECTION 1: SIMPLIFIED TEXT ===", "").strip()
-                    bullets = output.split("=== SECTION 2: BULLET POINT SUMMARY ===")[1].split("=== SECTION 3")[0].strip()
-                    glossary = output.split("=== SECTION 3: GLOSSARY ===")[1].strip()
+                    sections = parse_sections(output)
+                    if sections is None:
+                        # Model ignored the format: show everything as simplified text
+                        st.warning("Gemini didn't return the three expected sections, so its full answer is shown as simplified text.")
+                        sections = (output.strip(), "", "")
+                    simplified, bullets, glossary = sections
 
                     st.markdown("<div class='card'>", unsafe_allow_html=True)
                     st.subheader("📘 Simplified Text")
@@ -246,8 +621,8 @@ PDF CONTENT:
                     st.markdown(glossary)
                     st.markdown("</div>", unsafe_allow_html=True)
 
-                    pdf_output = generate_pdf(simplified, bullets, glossary)
-                    st.download_button("📥 Download Simplified PDF", data=pdf_output, file_name="Simplified.pdf", mime="application/pdf")
+                    # Deferred: the PDF is only built (off the script thread) if the user clicks
+                    st.download_button("📥 Download Simplified PDF", data=lambda: generate_pdf(simplified, bullets, glossary), file_name="Simplified.pdf", mime="application/pdf")
 
                 except Exception as e:
                     st.error(f"Error during simplification: {e}")
@@ -260,30 +635,23 @@ with col_pdf:
     st.markdown("<div class='card'>", unsafe_allow_html=True)
     st.subheader("📝 Document Preview")
 
-    if st.session_state.uploaded_file_obj:
-        
-        # Ensure the file pointer is at the beginning before reading the full file bytes
-        st.session_state.uploaded_file_obj.seek(0)
-        pdf_bytes = st.session_state.uploaded_file_obj.read()
+    if st.session_state.pdf_bytes:
 
-        # Generate Base64 string
-        base64_pdf = base64.b64encode(pdf_bytes).decode("utf-8")
+        publish_pdf(st.session_state.pdf_bytes, st.session_state.pdf_hash)
 
+        # Point at the static copy instead of inlining the bytes, so a rerun
+        # only re-sends this small tag and the browser reuses its cached PDF
         pdf_display = f"""
-            <iframe src="data:application/pdf;base64,{base64_pdf}"
+            <iframe src="./app/static/{st.session_state.pdf_hash}.pdf"
                      width="100%" height="800px" type="application/pdf">
             </iframe>
         """
-        
-        # Use st.components.v1.html for more robust embedding
+
         try:
              import streamlit.components.v1 as components
              components.html(pdf_display, height=800)
         except Exception as e:
-             # This error is usually the Chrome block even for 1MB files if the
-             # Streamlit server sends a slightly corrupt Base64 string.
-             st.error(f"PDF Embed Error: {e}. If the PDF doesn't display, please try refreshing the page or using a different PDF file. (The file is only 1MB, so this is likely a browser/Streamlit rendering issue.)")
-
+             st.error(f"PDF Embed Error: {e}. If the PDF doesn't display, please try refreshing the page or using a different PDF file.")
 
     else:
         st.info("Upload a PDF file to preview it.")
@@ -317,39 +685,22 @@ with col_chat:
     if ask and question.strip():
         with st.spinner("Thinking..."):
 
-            # --- USING THE ENHANCED CHAT PROMPT ---
-            chat_prompt = f"""
-You are an expert teacher and document summarizer. Your goal is to provide a comprehensive, educational, and high-quality answer to the user's question, strictly based on the provided PDF content.
-
-**Answer Formatting Rules:**
-
-1.  **Detail and Length:** Do not limit the length of your response. Provide a detailed answer that fully addresses the question.
-2.  **Educational Style:** Use clear, simple language suitable for a student. Break down complex topics into digestible parts.
-3.  **Structure (Mandatory):**
-    * **Start** with a clear, concise introductory summary.
-    * **Use bold subheadings** (e.g., **Key Features**, **In Simple Terms**, **Example**) to structure the body of your response.
-    * **Use Markdown bullet points (-) or numbered lists (1.)** for any lists, types, steps, or features.
-4.  **Analogy/Example:** For any concept or definition, actively try to provide a simple, real-world analogy or example to aid understanding.
-
-**Source Constraint:**
-- You MUST only use the PDF content provided below.
-- Do NOT output headings like "Answer:" or similar.
-- Do NOT copy messy formatting from the PDF.
-
-PDF CONTENT:
-{st.session_state.raw_text}
-
-QUESTION:
-{question}
-
-If the answer is not found in the PDF, reply: 
-"Sorry, this specific information is not available in the document you provided."
-"""
-
             try:
-                model = genai.GenerativeModel(MODEL_NAME)
-                response = model.generate_content(chat_prompt)
-                st.session_state.chat_answer = response.text
+                # --- USING THE ENHANCED CHAT PROMPT ---
+                if use_retrieval(st.session_state.raw_text):
+                    excerpts = retrieve_excerpts(st.session_state.pdf_hash, st.session_state.raw_text, question)
+                    chat_prompt = CHAT_PROMPT.format(text=excerpts, question=question)
+                    model_fn = get_chat_model
+                else:
+                    cached_model = get_cached_chat_model() if use_context_cache(st.session_state.raw_text) else None
+                    if cached_model is not None:
+                        chat_prompt = CACHED_CHAT_PROMPT.format(question=question)
+                        model_fn = lambda: cached_model
+                    else:
+                        chat_prompt = CHAT_PROMPT.format(text=st.session_state.raw_text, question=question)
+                        model_fn = get_chat_model
+
+                st.session_state.chat_answer = stream_gemini(chat_prompt, st.session_state.pdf_hash, st.empty(), model_fn)
             except Exception as e:
                 st.error(f"Chat error: {e}")
 